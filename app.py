@@ -1,13 +1,48 @@
-from flask import Flask, request, jsonify
+# Patch blocking stdlib calls (time.sleep, sockets) before anything imports them
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, Response, g, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import time
 import random
 import logging
-from functools import wraps
-from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from werkzeug.exceptions import HTTPException
+from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, multiprocess
 import psutil
 import os
+import threading
+import itertools
+import math
+from collections import OrderedDict
+import orjson
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes with orjson, falling back to the stdlib
+    
+    orjson rejects values the stdlib handles, such as integers wider than
+    64 bits or nesting deeper than 255 levels. Those fall back to the default
+    provider, which also keeps parsing request bodies with the stdlib so large
+    integers are not turned into floats.
+    """
+    
+    def dumps(self, obj, **kwargs):
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            return super().dumps(obj, **kwargs)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping a str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -16,91 +51,131 @@ logger = logging.getLogger(__name__)
 # Prometheus metrics
 REQUEST_COUNT = Counter('flask_http_request_total', 'Total HTTP requests', ['method', 'endpoint', 'status'])
 REQUEST_DURATION = Histogram('flask_http_request_duration_seconds', 'HTTP request duration', ['method', 'endpoint'])
-ERROR_COUNT = Counter('flask_http_errors_total', 'Total HTTP errors', ['method', 'endpoint', 'status'])
 ORDER_COUNT = Counter('flask_orders_total', 'Total orders created')
-ACTIVE_CONNECTIONS = Gauge('flask_active_connections', 'Active connections')
+ACTIVE_CONNECTIONS = Gauge('flask_active_connections', 'Active connections', multiprocess_mode='livesum')
 
 # System metrics
-CPU_USAGE = Gauge('system_cpu_usage_percent', 'CPU usage percentage')
-MEMORY_USAGE = Gauge('system_memory_usage_percent', 'Memory usage percentage')
-DISK_USAGE = Gauge('system_disk_usage_percent', 'Disk usage percentage')
+CPU_USAGE = Gauge('system_cpu_usage_percent', 'CPU usage percentage', multiprocess_mode='livemostrecent')
+MEMORY_USAGE = Gauge('system_memory_usage_percent', 'Memory usage percentage', multiprocess_mode='livemostrecent')
+DISK_USAGE = Gauge('system_disk_usage_percent', 'Disk usage percentage', multiprocess_mode='livemostrecent')
+
+# Process metrics, reported per pid when several workers run
+PROCESS_MEMORY_RSS = Gauge('flask_process_memory_rss_bytes', 'Resident memory of the app process', multiprocess_mode='liveall')
+PROCESS_THREADS = Gauge('flask_process_threads', 'Threads in the app process', multiprocess_mode='liveall')
+PROCESS_CPU_USAGE = Gauge('flask_process_cpu_usage_percent', 'CPU usage percentage of the app process', multiprocess_mode='liveall')
 
-# In-memory storage for demo
-orders = []
-active_connections = 0
+# With several gunicorn workers, /metrics aggregates the files every worker writes
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    metrics_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(metrics_registry)
+else:
+    metrics_registry = REGISTRY
 
-def update_system_metrics():
-    """Update system metrics"""
+# Add random processing delays to the order endpoints
+SIMULATE_LATENCY = os.getenv('SIMULATE_LATENCY') == '1'
+
+# In-memory storage for demo. The store and id sequence are per process, so
+# with several gunicorn workers each one holds different orders and the same
+# id can be handed out by more than one worker.
+# Oldest orders are evicted once MAX_ORDERS is reached
+MAX_ORDERS = int(os.getenv('MAX_ORDERS', 10000))
+orders = OrderedDict()  # keyed by order id, oldest first
+_next_order_id = itertools.count(1)
+
+# Seconds between system metric samples. The sampler is the only caller of
+# psutil, so this is also the poll throttle: /metrics scrapes only read the
+# gauge values, however often they arrive.
+SAMPLE_INTERVAL = float(os.getenv('METRICS_SAMPLE_INTERVAL', 10))
+_sampler_pid = None
+
+def update_system_metrics(process):
+    """Update system and process metrics"""
     try:
-        CPU_USAGE.set(psutil.cpu_percent())
+        CPU_USAGE.set(psutil.cpu_percent(interval=None))
         MEMORY_USAGE.set(psutil.virtual_memory().percent)
         DISK_USAGE.set(psutil.disk_usage('/').percent)
+        
+        # Read /proc/<pid> once for all process stats
+        with process.oneshot():
+            PROCESS_MEMORY_RSS.set(process.memory_info().rss)
+            PROCESS_THREADS.set(process.num_threads())
+            PROCESS_CPU_USAGE.set(process.cpu_percent())
     except Exception as e:
         logger.error(f"Error updating system metrics: {e}")
 
-def metrics_middleware(f):
-    """Decorator to track metrics for endpoints"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        start_time = time.time()
-        
-        try:
-            # Increment active connections
-            global active_connections
-            active_connections += 1
-            ACTIVE_CONNECTIONS.set(active_connections)
-            
-            # Execute the function
-            response = f(*args, **kwargs)
-            
-            # Record metrics
-            duration = time.time() - start_time
-            status_code = getattr(response, 'status_code', 200)
-            
-            REQUEST_COUNT.labels(
-                method=request.method,
-                endpoint=request.endpoint or 'unknown',
-                status=status_code
-            ).inc()
-            
-            REQUEST_DURATION.labels(
-                method=request.method,
-                endpoint=request.endpoint or 'unknown'
-            ).observe(duration)
-            
-            # Track errors
-            if status_code >= 400:
-                ERROR_COUNT.labels(
-                    method=request.method,
-                    endpoint=request.endpoint or 'unknown',
-                    status=status_code
-                ).inc()
-            
-            return response
-            
-        except Exception as e:
-            # Record error metrics
-            ERROR_COUNT.labels(
-                method=request.method,
-                endpoint=request.endpoint or 'unknown',
-                status=500
-            ).inc()
-            
-            logger.error(f"Error in {request.endpoint}: {e}")
-            return jsonify({"error": "Internal server error"}), 500
-            
-        finally:
-            # Decrement active connections
-            active_connections -= 1
-            ACTIVE_CONNECTIONS.set(active_connections)
-            
-            # Update system metrics
-            update_system_metrics()
+def _metrics_sampler(pid):
+    """Refresh system metrics every SAMPLE_INTERVAL seconds"""
+    # Reuse one Process so cpu_percent() measures since the previous sample
+    process = psutil.Process(pid)
+    # A gevent-patched thread is a greenlet and survives fork, so stop if
+    # this sampler was inherited by a child process
+    while os.getpid() == pid:
+        update_system_metrics(process)
+        time.sleep(SAMPLE_INTERVAL)
+
+def start_metrics_sampler():
+    """Start the system metrics sampler once per process"""
+    global _sampler_pid
+    # Called from __main__ and from gunicorn's post_worker_init in each worker
+    if _sampler_pid == os.getpid():
+        return
+    _sampler_pid = os.getpid()
+    threading.Thread(target=_metrics_sampler, args=(_sampler_pid,), name='metrics-sampler', daemon=True).start()
+
+# Labeled metric children, resolved once per label combination
+_metric_children = {}
+
+def get_child(metric, *labels):
+    """Return metric.labels(*labels), memoized across requests"""
+    key = (id(metric), labels)
+    child = _metric_children.get(key)
+    if child is None:
+        child = _metric_children[key] = metric.labels(*labels)
+    return child
+
+@app.before_request
+def start_request_metrics():
+    """Start timing the request and count it as an active connection"""
+    # Scrapes of /metrics and URLs that match no route are not tracked
+    if request.url_rule is None or request.endpoint == 'metrics':
+        return
+    g.metrics_start_time = time.perf_counter()
+    ACTIVE_CONNECTIONS.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    """Record request count and duration for the finished response"""
+    start_time = g.get('metrics_start_time')
+    if start_time is None:
+        return response
+    
+    duration = time.perf_counter() - start_time
+    # Resolve request labels once instead of on every metric call
+    method = request.method
+    endpoint = request.endpoint
+    
+    get_child(REQUEST_COUNT, method, endpoint, response.status_code).inc()
+    get_child(REQUEST_DURATION, method, endpoint).observe(duration)
+    
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    """Decrement active connections once the request is torn down"""
+    if 'metrics_start_time' in g:
+        ACTIVE_CONNECTIONS.dec()
+
+@app.errorhandler(Exception)
+def handle_exception(e):
+    """Return a JSON 500 for unhandled errors so they are still recorded"""
+    # Let Flask render HTTP errors such as 404 and 405 as usual
+    if isinstance(e, HTTPException):
+        return e
     
-    return decorated_function
+    logger.error(f"Error in {request.endpoint}: {e}")
+    return jsonify({"error": "Internal server error"}), 500
 
 @app.route('/health')
-@metrics_middleware
 def health_check():
     """Health check endpoint"""
     return jsonify({
@@ -112,69 +187,74 @@ def health_check():
 @app.route('/metrics')
 def metrics():
     """Prometheus metrics endpoint"""
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+    return Response(generate_latest(metrics_registry), content_type=CONTENT_TYPE_LATEST)
 
 @app.route('/api/orders', methods=['GET'])
-@metrics_middleware
 def get_orders():
     """Get all orders"""
     # Simulate some processing time
-    time.sleep(random.uniform(0.1, 0.5))
+    if SIMULATE_LATENCY:
+        time.sleep(random.uniform(0.1, 0.5))
     
     return jsonify({
-        "orders": orders,
+        "orders": list(orders.values()),
         "total": len(orders)
     })
 
 @app.route('/api/orders', methods=['POST'])
-@metrics_middleware
 def create_order():
     """Create a new order"""
     try:
         data = request.get_json()
         
         # Simulate processing time
-        time.sleep(random.uniform(0.2, 0.8))
+        if SIMULATE_LATENCY:
+            time.sleep(random.uniform(0.2, 0.8))
         
         # Simulate occasional errors
         if random.random() < 0.1:  # 10% error rate
             return jsonify({"error": "Order processing failed"}), 500
         
         # Create order
+        order_id = next(_next_order_id)
         order = {
-            "id": len(orders) + 1,
+            "id": order_id,
             "product": data.get('product', 'Unknown'),
             "quantity": data.get('quantity', 1),
             "price": data.get('price', 0),
             "timestamp": time.time()
         }
         
-        orders.append(order)
+        # Serialize first so an order that cannot be returned is never stored
+        response = jsonify(order)
+        
+        orders[order_id] = order
+        if len(orders) > MAX_ORDERS:
+            orders.popitem(last=False)
         ORDER_COUNT.inc()
         
         logger.info(f"Order created: {order['id']}")
         
-        return jsonify(order), 201
+        return response, 201
         
     except Exception as e:
         logger.error(f"Error creating order: {e}")
         return jsonify({"error": "Invalid order data"}), 400
 
 @app.route('/api/orders/<int:order_id>', methods=['GET'])
-@metrics_middleware
 def get_order(order_id):
     """Get specific order"""
     # Simulate processing time
-    time.sleep(random.uniform(0.05, 0.3))
+    if SIMULATE_LATENCY:
+        time.sleep(random.uniform(0.05, 0.3))
     
-    order = next((o for o in orders if o['id'] == order_id), None)
+    order = orders.get(order_id)
     if not order:
         return jsonify({"error": "Order not found"}), 404
     
     return jsonify(order)
 
 @app.route('/api/simulate-error')
-@metrics_middleware
 def simulate_error():
     """Endpoint to simulate errors for testing"""
     error_type = request.args.get('type', 'server')
@@ -187,45 +267,49 @@ def simulate_error():
         return jsonify({"error": "Not found simulation"}), 404
 
 @app.route('/api/simulate-slow')
-@metrics_middleware
 def simulate_slow():
     """Endpoint to simulate slow responses"""
     delay = float(request.args.get('delay', 2.0))
+    # gevent's sleep never returns for nan, so reject it along with negatives
+    if not (math.isfinite(delay) and delay >= 0):
+        return jsonify({"error": "delay must be a finite, non-negative number of seconds"}), 400
     time.sleep(delay)
     return jsonify({"message": f"Delayed response after {delay} seconds"})
 
 @app.route('/api/memory-stress')
-@metrics_middleware
 def memory_stress():
     """Endpoint to simulate memory usage"""
     # Simulate memory usage
-    size = int(request.args.get('size', 100))  # MB
-    data = 'x' * (size * 1024 * 1024)  # Create large string
+    size = max(int(request.args.get('size', 100)), 0)  # MB, negative sizes allocate nothing
+    data = bytearray(size << 20)  # Create large zeroed buffer
     
     return jsonify({
         "message": f"Allocated {size}MB of memory",
         "size": len(data)
     })
 
+# The index payload never changes, so serialize it once at import
+INDEX_BODY = orjson.dumps({
+    "service": "Flask Observability App",
+    "version": "1.0.0",
+    "endpoints": {
+        "/health": "Health check",
+        "/metrics": "Prometheus metrics",
+        "/api/orders": "Order management",
+        "/api/simulate-error": "Error simulation",
+        "/api/simulate-slow": "Slow response simulation",
+        "/api/memory-stress": "Memory stress test"
+    }
+})
+
 @app.route('/')
-@metrics_middleware
 def index():
     """Main index page"""
-    return jsonify({
-        "service": "Flask Observability App",
-        "version": "1.0.0",
-        "endpoints": {
-            "/health": "Health check",
-            "/metrics": "Prometheus metrics",
-            "/api/orders": "Order management",
-            "/api/simulate-error": "Error simulation",
-            "/api/simulate-slow": "Slow response simulation",
-            "/api/memory-stress": "Memory stress test"
-        }
-    })
+    return Response(INDEX_BODY, mimetype='application/json')
 
 if __name__ == '__main__':
-    # Initialize system metrics
-    update_system_metrics()
+    # Sample system metrics in the background instead of on every request
+    start_metrics_sampler()
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # The reloader would fork a second process and re-import the app
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG') == '1', use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,47 @@
+# Gunicorn configuration for the Flask observability app
+import glob
+import os
+
+bind = '0.0.0.0:5000'
+
+# gevent workers yield on blocking sleeps and socket I/O instead of
+# serializing requests like the Werkzeug dev server, so one worker
+# already serves many concurrent requests
+worker_class = 'gevent'
+worker_connections = 1000
+
+# Metrics and orders live in process memory, so more than one worker
+# needs prometheus_client multiprocess mode to report consistent metrics
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if workers > 1 and not multiproc_dir:
+    raise RuntimeError('GUNICORN_WORKERS > 1 requires PROMETHEUS_MULTIPROC_DIR to be set')
+
+# Clear metric files left over from a previous run. This happens here rather
+# than in on_starting because the preloaded app creates its files first.
+if multiproc_dir:
+    os.makedirs(multiproc_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+        os.remove(path)
+
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+def when_ready(server):
+    """Drop the idle live gauges the preloaded master created at import"""
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(os.getpid())
+
+def post_worker_init(worker):
+    """Start the system metrics sampler inside each forked worker"""
+    from app import start_metrics_sampler
+    start_metrics_sampler()
+
+def child_exit(server, worker):
+    """Drop the live gauge values of a worker that has exited"""
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,41 +1,130 @@
 #!/usr/bin/env python3
 
 from flask import Flask, request, jsonify
+import atexit
+import docker
 import subprocess
 import logging
-import json
+import orjson
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+APP_CONTAINER = 'flask-observability-app'
+_docker_client = None
+
+def restart_app_container():
+    """Restart the Flask app container through the Docker API"""
+    global _docker_client
+    # Keep one client so restarts reuse the Docker socket connection
+    if _docker_client is None:
+        _docker_client = docker.from_env()
+    _docker_client.containers.get(APP_CONTAINER).restart()
+
+ALERT_LOG_FILE = '/var/log/alerts.log'
+# Seconds between batched writes to the alert log
+LOG_FLUSH_INTERVAL = 0.1
+# Seconds to wait before retrying a failed open or write
+LOG_RETRY_INTERVAL = 5
+# Alerts are rejected once this many batches are waiting to be written
+LOG_QUEUE_SIZE = 10000
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_lock = threading.Lock()
+_log_file = None
+
+def _take_queued(batch):
+    """Move everything currently queued into batch"""
+    while True:
+        try:
+            batch.append(log_queue.get_nowait())
+        except queue.Empty:
+            return batch
+
+def _write_alert_log(data):
+    """Append data to the alert log, opening it if needed"""
+    global _log_file
+    with _log_lock:
+        try:
+            if _log_file is None:
+                # Ensure log directory exists
+                os.makedirs(os.path.dirname(ALERT_LOG_FILE), exist_ok=True)
+                _log_file = open(ALERT_LOG_FILE, 'ab')
+            _log_file.write(data)
+            _log_file.flush()
+        except OSError:
+            # Reopen on the next attempt
+            if _log_file is not None:
+                try:
+                    _log_file.close()
+                except OSError:
+                    pass
+            _log_file = None
+            raise
+
+def _drain_alert_log():
+    """Write queued alert log entries in batches, keeping the file open"""
+    while True:
+        data = b''.join(_take_queued([log_queue.get()]))
+        while True:
+            try:
+                _write_alert_log(data)
+                break
+            except OSError as e:
+                logger.error(f"Failed to write alert log, retrying in {LOG_RETRY_INTERVAL}s: {e}")
+                time.sleep(LOG_RETRY_INTERVAL)
+        
+        time.sleep(LOG_FLUSH_INTERVAL)
+
+def _flush_alert_log():
+    """Write whatever is still queued when the process exits"""
+    pending = _take_queued([])
+    if pending:
+        try:
+            _write_alert_log(b''.join(pending))
+        except OSError as e:
+            logger.error(f"Dropped {len(pending)} queued alert log entries at exit: {e}")
+
+threading.Thread(target=_drain_alert_log, name='alert-log-writer', daemon=True).start()
+atexit.register(_flush_alert_log)
+
 @app.route('/webhook', methods=['POST'])
 def handle_alert():
     """Handle incoming alerts from Alertmanager"""
     try:
         alert_data = request.get_json()
+        received = []
+        log_lines = []
+        parse_error = None
         
-        for alert in alert_data.get('alerts', []):
-            alert_name = alert.get('labels', {}).get('alertname', 'Unknown')
-            status = alert.get('status', 'unknown')
-            
-            # Log the alert
-            log_entry = {
-                'timestamp': datetime.now().isoformat(),
-                'alert': alert_name,
-                'status': status,
-                'labels': alert.get('labels', {}),
-                'annotations': alert.get('annotations', {})
-            }
-            
-            # Ensure log directory exists
-            os.makedirs('/var/log', exist_ok=True)
-            
-            with open('/var/log/alerts.log', 'a') as f:
-                f.write(json.dumps(log_entry) + '\n')
-            
+        try:
+            for alert in alert_data.get('alerts', []):
+                alert_name = alert.get('labels', {}).get('alertname', 'Unknown')
+                status = alert.get('status', 'unknown')
+                
+                # Log the alert; orjson writes the datetime in ISO format
+                log_lines.append(orjson.dumps({
+                    'timestamp': datetime.now(),
+                    'alert': alert_name,
+                    'status': status,
+                    'labels': alert.get('labels', {}),
+                    'annotations': alert.get('annotations', {})
+                }) + b'\n')
+                received.append((alert_name, status))
+        except Exception as e:
+            # Still remediate the alerts read before the malformed one
+            parse_error = e
+        
+        # Queue the whole notification as one write before any remediation runs
+        if log_lines:
+            log_queue.put_nowait(b''.join(log_lines))
+        
+        for alert_name, status in received:
             logger.info(f"Received alert: {alert_name} - {status}")
             
             # Execute remediation scripts based on alert type
@@ -44,11 +133,9 @@ def handle_alert():
                     logger.info("Executing memory remediation - restarting Flask app container")
                     try:
                         # Restart the Flask app container
-                        subprocess.run([
-                            'docker', 'restart', 'flask-observability-app'
-                        ], check=True, capture_output=True, text=True)
+                        restart_app_container()
                         logger.info("Flask app container restarted successfully")
-                    except subprocess.CalledProcessError as e:
+                    except docker.errors.DockerException as e:
                         logger.error(f"Failed to restart Flask app container: {e}")
                 
                 elif alert_name == 'HighDiskUsage':
@@ -64,15 +151,20 @@ def handle_alert():
                 elif alert_name == 'AppDown':
                     logger.info("App is down - attempting to restart container")
                     try:
-                        subprocess.run([
-                            'docker', 'restart', 'flask-observability-app'
-                        ], check=True, capture_output=True, text=True)
+                        restart_app_container()
                         logger.info("Flask app container restarted due to app down alert")
-                    except subprocess.CalledProcessError as e:
+                    except docker.errors.DockerException as e:
                         logger.error(f"Failed to restart app container: {e}")
         
+        if parse_error is not None:
+            raise parse_error
+        
         return jsonify({'status': 'success'}), 200
         
+    except queue.Full:
+        logger.error("Alert log queue is full, the log writer is not keeping up")
+        return jsonify({'error': 'Alert log unavailable'}), 500
+    
     except Exception as e:
         logger.error(f"Error processing alert: {e}")
         return jsonify({'error': str(e)}), 500
@@ -83,4 +175,5 @@ def health_check():
     return jsonify({'status': 'healthy', 'service': 'alert-webhook'}), 200
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    # The reloader would fork a second process and re-import the app
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv('FLASK_DEBUG') == '1', use_reloader=False)
\ No newline at end of file